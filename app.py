@@ -1,10 +1,25 @@
 # app.py
 
+import html
+import json
+import sqlite3
+import threading
+import time
 import streamlit as st
-from helpers import init_profile, get_response
+from helpers import init_profile, get_core_response, polish_async
 import datetime
 import uuid
 
+# Saved chats live in this SQLite file; each owner keeps only their newest MAX_HISTORY
+DB_PATH = "finbot.db"
+MAX_HISTORY = 50
+
+# Repeats of the same button within this many seconds are treated as a double-tap
+DOUBLE_TAP_SECONDS = 1.0
+
+# Messages are stored as compact (role, content) tuples
+USER, ASSISTANT = 0, 1
+
 # --- Page Configuration ---
 st.set_page_config(
     page_title="FinBot Pro",
@@ -14,7 +29,7 @@ st.set_page_config(
 )
 
 # --- Custom CSS for Chat Bubbles and Background ---
-st.markdown("""
+_CSS = """
 <style>
     /* Professional Gradient Background */
     .stApp {
@@ -44,12 +59,14 @@ st.markdown("""
         color: #ffffff; 
         float: right; /* Pushes the message to the right side */
         clear: both; /* Prevents overlap with previous messages */
+        align-self: flex-end; /* Float is ignored inside the flex .chat-container */
     }
     .assistant-message { 
         background-color: #4e5563; 
         color: #ffffff; 
         float: left; /* Pushes the message to the left side */
         clear: both; /* Prevents overlap with previous messages */
+        align-self: flex-start;
     }
 
     /* Clearfix to ensure the container wraps around the floated elements */
@@ -57,14 +74,6 @@ st.markdown("""
         display: flow-root;
     }
     
-    /* Style for the feature buttons container */
-    .features-container {
-        padding: 1rem;
-        border: 1px solid #4e5563;
-        border-radius: 0.5rem;
-        margin-bottom: 1rem;
-    }
-    
     /* Home page styles */
     .main-page {
         text-align: center;
@@ -72,165 +81,280 @@ st.markdown("""
         color: #f0f2f6; /* Ensures text is visible on the dark background */
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+st.markdown(_CSS, unsafe_allow_html=True)
+
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _greeting_html(hour):
+    """Builds the home-page greeting block for the given hour of the day."""
+    if hour < 12:
+        greeting = "Good Morning"
+    elif hour < 17:
+        greeting = "Good Afternoon"
+    else:
+        greeting = "Good Evening"
+
+    return f"""
+    <div class="main-page">
+        <h1>{greeting}! Welcome to FinBot Pro 🤖</h1>
+        <p>Your personal finance journey starts here. Let's get your money in order and work towards your goals.</p>
+        <br>
+        <p>Ready to get started?</p>
+    </div>
+    """
+
+
+# --- Chat Rendering ---
+def render_messages(messages):
+    """Renders a list of chat messages as a single escaped HTML block."""
+    html_parts = ['<div class="chat-container">']
+    for role, content in messages:
+        cls = "user-message" if role == USER else "assistant-message"
+        # <br> keeps blank lines in replies from ending the HTML block early
+        content = html.escape(content).replace("\n", "<br>")
+        html_parts.append(f'<div class="chat-message {cls}"><span>{content}</span></div>')
+    html_parts.append('</div>')
+    st.markdown("".join(html_parts), unsafe_allow_html=True)
+
+def normalize_messages(messages):
+    """Converts legacy {"role", "content"} dict messages to (role, content) tuples."""
+    return [
+        ((USER if msg["role"] == "user" else ASSISTANT), msg["content"]) if isinstance(msg, dict) else msg
+        for msg in messages
+    ]
 
 
 # --- History Management Functions ---
+@st.cache_resource
+def _db():
+    """
+    Opens the chat history database once and shares the connection across sessions.
+    Returns (connection, lock); every use of the connection must hold the lock.
+    """
+    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    con.execute("CREATE TABLE IF NOT EXISTS chats(id TEXT PRIMARY KEY, owner TEXT, ts TEXT, title TEXT, messages TEXT)")
+    con.execute("CREATE INDEX IF NOT EXISTS chats_owner_ts ON chats(owner, ts)")
+    con.commit()
+    return con, threading.Lock()
+
+def list_saved_chats(limit=MAX_HISTORY):
+    """Returns (id, timestamp, title) rows for this owner's newest saved chats, without their messages."""
+    con, lock = _db()
+    with lock:
+        return con.execute(
+            "SELECT id, ts, title FROM chats WHERE owner = ? ORDER BY ts DESC, rowid DESC LIMIT ?",
+            (st.session_state.owner_id, limit),
+        ).fetchall()
+
+def load_chat_messages(chat_id):
+    """Loads the messages of one of this owner's saved chats as (role, content) tuples."""
+    con, lock = _db()
+    with lock:
+        row = con.execute(
+            "SELECT messages FROM chats WHERE id = ? AND owner = ?", (chat_id, st.session_state.owner_id)
+        ).fetchone()
+    return [tuple(msg) for msg in json.loads(row[0])] if row else []
+
 def save_current_chat():
     """Saves the current chat to history if it's not empty."""
     if st.session_state.messages and len(st.session_state.messages) > 1: # Check for at least one user message
-        title = st.session_state.messages[1]['content'][:50] + "..." if len(st.session_state.messages) > 1 else "New Chat"
+        title = st.session_state.messages[1][1][:50] + "..." if len(st.session_state.messages) > 1 else "New Chat"
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
         
-        st.session_state.chat_history.append({
-            "id": str(uuid.uuid4()),
-            "title": title,
-            "timestamp": timestamp,
-            "messages": st.session_state.messages
-        })
+        owner = st.session_state.owner_id
+        con, lock = _db()
+        with lock, con:
+            con.execute(
+                "INSERT INTO chats(id, owner, ts, title, messages) VALUES (?, ?, ?, ?, ?)",
+                (str(uuid.uuid4()), owner, timestamp, title, json.dumps(st.session_state.messages)),
+            )
+            # Keep the table bounded: drop this owner's chats beyond the newest MAX_HISTORY
+            con.execute(
+                "DELETE FROM chats WHERE owner = ? AND rowid NOT IN "
+                "(SELECT rowid FROM chats WHERE owner = ? ORDER BY ts DESC, rowid DESC LIMIT ?)",
+                (owner, owner, MAX_HISTORY),
+            )
     # Reset chat
     st.session_state.messages = []
     st.session_state.profile = init_profile()
     st.session_state.messages.append(
-        {"role": "assistant", "content": "Hello! 👋 I’m your Personal Finance Assistant. How can I help you today? Choose an option below or type your question."}
+        (ASSISTANT, "Hello! 👋 I’m your Personal Finance Assistant. How can I help you today? Choose an option below or type your question.")
     )
     st.session_state.user_action = None
 
 def navigate_to(page):
-    """Sets the current page and handles saving the current chat."""
+    """Sets the current page and handles saving the current chat. Used as an on_click callback."""
     if st.session_state.current_page == "chatbot" and page != "chatbot":
         save_current_chat()
     st.session_state.current_page = page
-    st.rerun()
+
+def set_user_action(action):
+    """Queues an action for the chatbot to handle. Used as an on_click callback."""
+    st.session_state.user_action = action
 
 # --- Session State Initialization ---
+if "owner_id" not in st.session_state:
+    # Scopes saved chats in the shared database to this user. The token lives in the
+    # URL so reloads and server restarts find the same history.
+    owner_id = st.query_params.get("uid") or str(uuid.uuid4())
+    st.query_params["uid"] = owner_id
+    st.session_state.owner_id = owner_id
 if "messages" not in st.session_state:
     st.session_state["messages"] = []
     st.session_state["profile"] = init_profile()
     st.session_state["messages"].append(
-        {"role": "assistant", "content": "Hello! 👋 I’m your Personal Finance Assistant. How can I help you today? Choose an option below or type your question."}
+        (ASSISTANT, "Hello! 👋 I’m your Personal Finance Assistant. How can I help you today? Choose an option below or type your question.")
     )
 if "user_action" not in st.session_state:
     st.session_state.user_action = None
 if "show_home" not in st.session_state:
     st.session_state.show_home = True
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
 if "current_page" not in st.session_state:
     st.session_state.current_page = "home"
+if "pending_polish" not in st.session_state:
+    st.session_state.pending_polish = None
+if "handled_action" not in st.session_state:
+    st.session_state.handled_action = None
+if "messages_normalized" not in st.session_state:
+    # One-time migration of sessions that still hold dict messages
+    st.session_state.messages = normalize_messages(st.session_state.messages)
+    st.session_state.messages_normalized = True
 
 
 # --- Sidebar Content ---
-with st.sidebar:
-    st.title("FinBot Pro 🤖")
-    st.markdown("Your intelligent assistant for mastering personal finance.")
-    
-    st.markdown("---")
-    st.subheader("Navigation")
-    if st.button("🏠 Home", use_container_width=True):
-        navigate_to("home")
-    if st.button("💬 Chatbot", use_container_width=True):
-        navigate_to("chatbot")
-    if st.button("📜 History", use_container_width=True):
-        navigate_to("history")
-    
-    st.markdown("---")
-    st.markdown("Built with ❤️ using [Streamlit](https://streamlit.io/)")
-
+# Static parts are sent as one markdown element each instead of one per heading/line
+_SIDEBAR_TOP = (
+    "<h1>FinBot Pro 🤖</h1>"
+    "<p>Your intelligent assistant for mastering personal finance.</p>"
+    "<hr>"
+    "<h3>Navigation</h3>"
+)
+_SIDEBAR_FOOTER = "<hr><p>Built with ❤️ using <a href='https://streamlit.io/'>Streamlit</a></p>"
 
-# --- Main Application Logic (Page Routing) ---
-if st.session_state.current_page == "home":
-    # Get current time to determine the greeting
-    now = datetime.datetime.now()
-    if now.hour < 12:
-        greeting = "Good Morning"
-    elif 12 <= now.hour < 17:
-        greeting = "Good Afternoon"
-    else:
-        greeting = "Good Evening"
-        
-    st.markdown(f"""
-    <div class="main-page">
-        <h1>{greeting}! Welcome to FinBot Pro 🤖</h1>
-        <p>Your personal finance journey starts here. Let's get your money in order and work towards your goals.</p>
-        <br>
-        <p>Ready to get started?</p>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    if st.button("Let's Get Started", use_container_width=True):
-        navigate_to("chatbot")
+with st.sidebar:
+    st.markdown(_SIDEBAR_TOP, unsafe_allow_html=True)
+    st.button("🏠 Home", use_container_width=True, on_click=navigate_to, args=("home",))
+    st.button("💬 Chatbot", use_container_width=True, on_click=navigate_to, args=("chatbot",))
+    st.button("📜 History", use_container_width=True, on_click=navigate_to, args=("history",))
+    st.markdown(_SIDEBAR_FOOTER, unsafe_allow_html=True)
 
 
-elif st.session_state.current_page == "chatbot":
+# --- Page Fragments ---
+# Widget interactions inside a fragment rerun only that fragment, not the sidebar or CSS.
+@st.fragment
+def chatbot_page():
     st.header("Your Personal Finance Chat")
     st.markdown("Let's manage your money and achieve your financial goals together!")
     st.divider()
-    
-    # --- Display "Back to Features" button if a conversation is active ---
-    if st.session_state.profile.get("conversation_state"):
-        if st.button("⬅️ Back to Features"):
-            st.session_state.user_action = "back"
-            st.rerun()
-
-    # --- Display Feature Buttons for New Chats ---
-    if len(st.session_state.messages) <= 1 or not st.session_state.profile.get("conversation_state"):
-        with st.container():
-            st.markdown("<div class='features-container'>", unsafe_allow_html=True)
-            st.subheader("What would you like to do?")
-            col1, col2 = st.columns(2)
-            with col1:
-                if st.button("📊 Create a Budget", use_container_width=True):
-                    st.session_state.user_action = "Create a budget"
-                    st.rerun()
-                if st.button("🆘 Calculate Emergency Fund", use_container_width=True):
-                    st.session_state.user_action = "Calculate my emergency fund"
-                    st.rerun()
-            with col2:
-                if st.button("🎯 Set a Savings Goal", use_container_width=True):
-                    st.session_state.user_action = "Set a savings goal"
-                    st.rerun()
-                if st.button("📈 Get Investment Advice", use_container_width=True):
-                    st.session_state.user_action = "Give me investment advice"
-                    st.rerun()
-            st.markdown("</div>", unsafe_allow_html=True)
 
-    # Display previous messages from session state
-    for msg in st.session_state["messages"]:
-        if msg["role"] == "user":
-            st.markdown(f'<div class="chat-message user-message"><span>{msg["content"]}</span></div>', unsafe_allow_html=True)
-        else:
-            st.markdown(f'<div class="chat-message assistant-message"><span>{msg["content"]}</span></div>', unsafe_allow_html=True)
+    # Input is handled before these are filled, so a turn shows up without a second rerun
+    controls = st.container()
+    chat_area = st.container()
 
     # --- User Input and Chat Logic ---
     user_input = st.chat_input("Ask me about your finances...")
 
+    action = None
     if st.session_state.user_action:
-        user_input = st.session_state.user_action
+        action = st.session_state.user_action
         st.session_state.user_action = None # Reset it after use
+        # Ignore a double-tap: the same button again within DOUBLE_TAP_SECONDS of the last one
+        last = st.session_state.handled_action
+        if last and last[0] == action and time.monotonic() - last[1] < DOUBLE_TAP_SECONDS:
+            action = None
+        else:
+            user_input = action
 
     if user_input:
-        st.session_state["messages"].append({"role": "user", "content": user_input})
-        
-        with st.spinner("Thinking..."):
-            bot_reply = get_response(user_input, st.session_state["profile"])
-            st.session_state["messages"].append({"role": "assistant", "content": bot_reply})
+        messages = st.session_state["messages"]
+        messages.append((USER, user_input))
         
-        st.rerun()
+        # Show the rule-based reply right away; HF polishing runs in the background
+        bot_reply = get_core_response(user_input, st.session_state["profile"])
+        messages.append((ASSISTANT, bot_reply))
+        future = polish_async(bot_reply, user_input)
+        # Keep the list itself so a late polish never lands in a newer chat
+        st.session_state.pending_polish = (future, messages, len(messages) - 1) if future else None
+        if action:
+            st.session_state.handled_action = (action, time.monotonic())
+        if future:
+            # Full rerun so the routing below mounts polish_watcher for this reply
+            st.rerun()
 
+    with controls:
+        # --- Display "Back to Features" button if a conversation is active ---
+        if st.session_state.profile.get("conversation_state"):
+            st.button("⬅️ Back to Features", on_click=set_user_action, args=("back",))
 
-elif st.session_state.current_page == "history":
+        # --- Display Feature Buttons for New Chats ---
+        if len(st.session_state.messages) <= 1 or not st.session_state.profile.get("conversation_state"):
+            # A form renders as one bordered block and replaces the raw features-container markup
+            with st.form("features", clear_on_submit=False):
+                st.subheader("What would you like to do?")
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.form_submit_button("📊 Create a Budget", use_container_width=True, on_click=set_user_action, args=("Create a budget",))
+                    st.form_submit_button("🆘 Calculate Emergency Fund", use_container_width=True, on_click=set_user_action, args=("Calculate my emergency fund",))
+                with col2:
+                    st.form_submit_button("🎯 Set a Savings Goal", use_container_width=True, on_click=set_user_action, args=("Set a savings goal",))
+                    st.form_submit_button("📈 Get Investment Advice", use_container_width=True, on_click=set_user_action, args=("Give me investment advice",))
+
+    # Display previous messages from session state
+    with chat_area:
+        render_messages(st.session_state["messages"])
+
+
+# Polls the background HF call instead of blocking on it. Only mounted while a polish is
+# pending, next to chatbot_page rather than inside it so its timer survives that fragment's reruns.
+@st.fragment(run_every=1)
+def polish_watcher():
+    pending = st.session_state.pending_polish
+    if not pending:
+        return
+    future, messages, index = pending
+    if not future.done():
+        st.caption("Thinking...")
+        return
+    # Clear it before anything that can rerun, so a finished future is only applied once
+    st.session_state.pending_polish = None
+    polished = future.result()
+    if polished:
+        messages[index] = (ASSISTANT, polished)
+    # Full rerun shows the new wording and unmounts the watcher
+    st.rerun()
+
+
+@st.fragment
+def history_page():
     st.header("Chat History 📜")
     st.markdown("Review all your past conversations with FinBot Pro.")
     st.divider()
 
-    if not st.session_state.chat_history:
+    chats = list_saved_chats()
+    if not chats:
         st.info("No chat history available. Start a new conversation to save your history!")
     else:
-        for chat in reversed(st.session_state.chat_history):
-            with st.expander(f'**{chat["title"]}** - _{chat["timestamp"]}_'):
-                for msg in chat["messages"]:
-                    if msg["role"] == "user":
-                        st.markdown(f'<div class="chat-message user-message"><span>{msg["content"]}</span></div>', unsafe_allow_html=True)
-                    else:
-                        st.markdown(f'<div class="chat-message assistant-message"><span>{msg["content"]}</span></div>', unsafe_allow_html=True)
\ No newline at end of file
+        for chat_id, timestamp, title in chats:
+            with st.expander(f'**{title}** - _{timestamp}_'):
+                # Only load and build the message HTML for chats the user asks to see
+                if st.checkbox("Show", key=f"show_{chat_id}"):
+                    render_messages(load_chat_messages(chat_id))
+
+
+# --- Main Application Logic (Page Routing) ---
+if st.session_state.current_page == "home":
+    # Get current time to determine the greeting
+    st.markdown(_greeting_html(datetime.datetime.now().hour), unsafe_allow_html=True)
+    
+    st.button("Let's Get Started", use_container_width=True, on_click=navigate_to, args=("chatbot",))
+
+
+elif st.session_state.current_page == "chatbot":
+    chatbot_page()
+    if st.session_state.pending_polish:
+        polish_watcher()
+
+
+elif st.session_state.current_page == "history":
+    history_page()
@@ -1,7 +1,6 @@
-import os
-from dotenv import load_dotenv
+from env import load_env
 
-load_dotenv()
+settings = load_env()
 
-print("HF_TOKEN:", os.getenv("HF_TOKEN"))
-print("HF_MODEL:", os.getenv("HF_MODEL"))
+print("HF_TOKEN:", settings["HF_TOKEN"])
+print("HF_MODEL:", settings["HF_MODEL"])
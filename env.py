@@ -0,0 +1,14 @@
+# env.py
+import os
+from functools import lru_cache
+from dotenv import load_dotenv
+
+# Kept free of Streamlit/requests so check_env.py can import it on its own
+@lru_cache(maxsize=1)
+def load_env():
+    """Read .env once per process and return the HF settings."""
+    load_dotenv()
+    return {
+        "HF_TOKEN": os.getenv("HF_TOKEN"),
+        "HF_MODEL": os.getenv("HF_MODEL", "google/flan-t5-small"),
+    }
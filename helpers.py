@@ -1,24 +1,51 @@
 # helpers.py
 import re
-import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from dotenv import load_dotenv
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from env import load_env
 
 # Load environment variables from .env (if present)
-load_dotenv()
-HF_TOKEN = os.getenv("HF_TOKEN")
-HF_MODEL = os.getenv("HF_MODEL", "google/flan-t5-small")
+HF_TOKEN = load_env()["HF_TOKEN"]
+HF_MODEL = load_env()["HF_MODEL"]
 HF_API_URL = f"https://api-inference.huggingface.co/models/{HF_MODEL}"
 
+# Caps on prompt inputs so the polish prompt stays well inside flan-t5's 512-token window
+MAX_QUESTION_CHARS = 200
+MAX_REPLY_CHARS = 600
+
+# One pooled session so every chat turn reuses the same keep-alive TLS connection
+_HF_SESSION = requests.Session()
+if HF_TOKEN:
+    _HF_SESSION.headers.update({
+        "Authorization": f"Bearer {HF_TOKEN}",
+        "Content-Type": "application/json",
+    })
+
+# Background workers so HF polishing never blocks the Streamlit render thread
+_HF_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Compiled once at import; parse_number runs on every multi-step turn.
+# The leading \d keeps a bare comma ("hello, world") from matching as an empty number.
+_NUM_RE = re.compile(r'\d[\d,]*(?:\.\d+)?')
+# Thousands separators and currency symbols dropped by the parse_number fast path
+_DROP_NUM_CHARS = str.maketrans("", "", ",₹$")
+
 # ----------------- Hugging Face helper -----------------
-def call_hf_polish(core_reply, user_question, profile):
+@st.cache_data(ttl=3600, show_spinner=False)
+def call_hf_polish(core_reply, user_question):
     """
     Call Hugging Face Inference API to polish a rule-based reply.
-    Returns polished text, or None on failure.
+    Returns polished text and raises on failure, so only successes are cached
+    per (core_reply, user_question) and transient errors are retried next time.
     """
     if not HF_TOKEN:
-        return None
+        raise RuntimeError("HF_TOKEN is not set")
+
+    # Only the question is truncated; _should_polish keeps long replies away from HF entirely
+    user_question = user_question[:MAX_QUESTION_CHARS]
 
     # Construct a concise prompt to instruct the model to polish
     prompt = (
@@ -30,80 +57,177 @@ def call_hf_polish(core_reply, user_question, profile):
         "Polished reply:"
     )
 
-    headers = {"Authorization": f"Bearer {HF_TOKEN}"}
     payload = {
         "inputs": prompt,
-        "parameters": {"max_new_tokens": 200, "temperature": 0.2},
+        # A polish shouldn't grow the content, so scale the budget with the reply
+        "parameters": {"max_new_tokens": min(200, len(core_reply) // 2 + 40), "temperature": 0.2},
     }
 
-    try:
-        resp = requests.post(HF_API_URL, headers=headers, json=payload, timeout=30)
-        if resp.status_code != 200:
-            # If the API returns a non-200, return None to fallback cleanly
-            return None
-        data = resp.json()
-        # Parse possible response formats
-        # Common responses: [{"generated_text": "..."}] or {"generated_text": "..."}
-        if isinstance(data, list) and data and "generated_text" in data[0]:
-            out = data[0]["generated_text"]
-        elif isinstance(data, dict) and "generated_text" in data:
-            out = data["generated_text"]
-        elif isinstance(data, str):
-            out = data
-        else:
-            # Some models return other nested formats; try a best-effort
+    # Network errors and timeouts propagate from post(); callers fall back to core_reply
+    resp = _HF_SESSION.post(HF_API_URL, json=payload, timeout=30)
+    if resp.status_code != 200:
+        # e.g. 503 while the model is loading; raise so the failure isn't cached
+        raise RuntimeError(f"HF API returned {resp.status_code}")
+    data = resp.json()
+    # Parse possible response formats
+    # Common responses: [{"generated_text": "..."}] or {"generated_text": "..."}
+    if isinstance(data, list) and data and "generated_text" in data[0]:
+        out = data[0]["generated_text"]
+    elif isinstance(data, dict) and "generated_text" in data:
+        out = data["generated_text"]
+    elif isinstance(data, str):
+        out = data
+    else:
+        # Some models return other nested formats; try a best-effort
+        out = None
+        try:
+            # If it's a list of dicts with 'generated_text' deeper
+            out = data[0].get("generated_text")
+        except Exception:
             out = None
-            try:
-                # If it's a list of dicts with 'generated_text' deeper
-                out = data[0].get("generated_text")
-            except Exception:
-                out = None
-
-        if out:
-            return out.strip()
-    except Exception:
-        # Network error, timeout, auth failure, etc. — just return None to fallback
-        return None
 
-    return None
+    if not out or not out.strip():
+        raise RuntimeError("HF API returned no generated text")
+    return out.strip()
+
+def _should_polish(core_reply):
+    """
+    Short replies and formatted ₹ bullet breakdowns gain nothing from an HF round-trip,
+    and replies over MAX_REPLY_CHARS would lose their tail if polished from a truncated prompt.
+    """
+    if not HF_TOKEN or len(core_reply) < 120 or len(core_reply) > MAX_REPLY_CHARS:
+        return False
+    return not ("₹" in core_reply and "\n-" in core_reply)
 
 def maybe_polish_and_return(core_reply, user_question, profile):
     """Try to polish using HF; fallback to core_reply."""
-    polished = call_hf_polish(core_reply, user_question, profile)
-    return polished if polished else core_reply
+    if not _should_polish(core_reply):
+        return core_reply
+    try:
+        return call_hf_polish(core_reply, user_question)
+    except Exception:
+        # Network error, timeout, auth failure, etc. — fall back to the rule-based reply
+        return core_reply
+
+def polish_async(core_reply, user_question):
+    """
+    Submit an HF polish of core_reply to the background pool.
+    Returns a Future resolving to the polished text (or None), or None if no polish is needed.
+    """
+    if not _should_polish(core_reply):
+        return None
+
+    # Attach the caller's ScriptRunContext so st.cache_data works inside the worker
+    ctx = get_script_run_ctx()
+
+    def _run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            return call_hf_polish(core_reply, user_question)
+        except Exception:
+            return None
+
+    return _HF_POOL.submit(_run)
 
 # ----------------- Profile & parsing -----------------
+# Default profile values; every field is immutable so a shallow copy is enough
+_PROFILE_TEMPLATE = {
+    "income": 0,
+    "expenses": 0,
+    "risk_tolerance": "medium",
+    # This key tracks multi-step conversation state
+    "conversation_state": None
+}
+
 def init_profile():
     """Initialize a default user profile with more fields."""
-    return {
-        "income": 0,
-        "expenses": 0,
-        "risk_tolerance": "medium",
-        # This key tracks multi-step conversation state
-        "conversation_state": None
-    }
+    return _PROFILE_TEMPLATE.copy()
 
 def parse_number(text):
     """Extracts the first numerical value from a string."""
-    match = re.search(r'[\d,]+(?:\.\d+)?', text)
+    # Fast path for bare answers like "25,000" or "₹1500.50"; isdecimal() keeps out "inf", "1e5", "-3"
+    cleaned = text.strip().translate(_DROP_NUM_CHARS)
+    if cleaned.replace('.', '', 1).isdecimal():
+        return float(cleaned)
+    match = _NUM_RE.search(text)
     if match:
         return float(match.group(0).replace(',', ''))
     return None
 
+# ----------------- Keyword intents -----------------
+def _start_budget(profile):
+    profile["conversation_state"] = "getting_income_for_budget"
+    return "Let's create a budget. What is your total monthly income after tax? You can also type 'back' to return to the main menu."
+
+def _start_emergency(profile):
+    profile["conversation_state"] = "getting_emergency_expenses"
+    return "What are your essential monthly expenses (rent, food, utilities, EMIs)? You can also type 'back' to return to the main menu."
+
+def _start_goal(profile):
+    profile["conversation_state"] = "getting_goal_amount"
+    return "What is the target amount you want to save? You can also type 'back' to return to the main menu."
+
+def _tax_reply(profile):
+    return (
+        "In India, you can save taxes using several sections:\n\n"
+        "1. Section 80C (up to ₹1.5 lakh): PPF, ELSS, Life Insurance, principal repayment of home loan.\n"
+        "2. Section 80D: Health insurance premium deduction.\n"
+        "3. NPS (Section 80CCD(1B)): extra deduction of ₹50,000.\n\n"
+        "The best option depends on your goals and risk appetite."
+    )
+
+def _invest_reply(profile):
+    return (
+        "Investment options by risk:\n\n"
+        "- Low risk: FDs, PPF, Debt funds.\n"
+        "- Medium risk: Index funds, Balanced mutual funds.\n"
+        "- High risk: Direct equity, mid/small-cap funds, crypto (small allocation).\n\n"
+        "What is your risk tolerance (low, medium, high)?"
+    )
+
+def _greet(profile):
+    return "Hello! 👋 How can I help you with your finances today? Try: 'create a budget', 'set a goal', or 'tax'."
+
+# keyword -> (handler, whole_word). Checked in insertion order, so earlier keywords win
+# when several appear. Keywords match at a word start ("investment", "budgeting") unless
+# whole_word is set, which keeps "hi" from matching "history".
+_INTENT_HANDLERS = {
+    "budget": (_start_budget, False),
+    "plan": (_start_budget, False),
+    "emergency": (_start_emergency, False),
+    "goal": (_start_goal, False),
+    "tax": (_tax_reply, False),
+    "invest": (_invest_reply, False),
+    "hello": (_greet, True),
+    "hi": (_greet, True),
+}
+_INTENT_RE = re.compile(r"\b(" + "|".join(
+    re.escape(keyword) + (r"\b" if whole_word else "")
+    for keyword, (_, whole_word) in _INTENT_HANDLERS.items()
+) + ")")
+
 # ----------------- Core rule-based logic (unchanged flows) -----------------
 def get_response(user_input, profile):
     """
     Generates a response based on user input and conversation state.
     Uses rule-based logic for finance features and polishes replies with HF if available.
     """
-    raw_text = user_input.lower()
+    core = get_core_response(user_input, profile)
+    return maybe_polish_and_return(core, user_input, profile)
+
+def get_core_response(user_input, profile):
+    """
+    Generates the rule-based reply for user input and advances the conversation state.
+    Never touches the network; pair with polish_async to upgrade the wording.
+    """
+    raw_text = user_input.strip().lower()
     state = profile.get("conversation_state")
 
     # --- State machine: multi-step conversations ---
-    if raw_text.strip() == "back":
+    if raw_text == "back":
         profile["conversation_state"] = None
         core = "I've reset the conversation. How can I help you next?"
-        return maybe_polish_and_return(core, user_input, profile)
+        return core
 
     if state == "getting_income_for_budget":
         income = parse_number(user_input)
@@ -111,10 +235,10 @@ def get_response(user_input, profile):
             profile["income"] = income
             profile["conversation_state"] = "getting_expenses_for_budget"
             core = f"Great! Your monthly income is ₹{income:,.0f}. Now, what are your total monthly expenses (rent, bills, food, etc.)? You can also type 'back' to return to the main menu."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
         else:
             core = "I couldn't understand that number. Please provide your total monthly income. You can also type 'back' to return to the main menu."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
 
     elif state == "getting_expenses_for_budget":
         expenses = parse_number(user_input)
@@ -140,37 +264,33 @@ def get_response(user_input, profile):
                 core += "You're doing a great job with your savings! Keep it up."
             else:
                 core += "You're a bit below the 20% savings target. Consider trimming wants."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
         else:
             core = "I couldn't understand that number. Please provide your total monthly expenses. You can also type 'back' to return to the main menu."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
 
     elif state == "getting_goal_amount":
         amount = parse_number(user_input)
         if amount:
-            st.session_state.temp_goal_amount = amount
+            profile["_temp_goal_amount"] = amount
             profile["conversation_state"] = "getting_goal_time"
             core = f"Goal amount set to ₹{amount:,.0f}. In how many months do you want to achieve this goal? You can also type 'back' to return to the main menu."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
         else:
             core = "Please enter a valid target amount for your goal. You can also type 'back' to return to the main menu."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
 
     elif state == "getting_goal_time":
         months = parse_number(user_input)
         if months and months > 0:
-            amount = st.session_state.temp_goal_amount
+            amount = profile.pop("_temp_goal_amount", 0)
             monthly_savings = amount / months
             profile["conversation_state"] = None
-            try:
-                del st.session_state.temp_goal_amount
-            except Exception:
-                pass
             core = f"To reach your goal of ₹{amount:,.0f} in {int(months)} months, save ₹{monthly_savings:,.2f} every month."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
         else:
             core = "Please enter a valid number of months. You can also type 'back' to return to the main menu."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
 
     elif state == "getting_emergency_expenses":
         expenses = parse_number(user_input)
@@ -184,51 +304,18 @@ def get_response(user_input, profile):
                 f"- 6-month fund: ₹{fund_6_months:,.0f}\n\n"
                 "Keep this in a liquid/higher-yield savings option."
             )
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
         else:
             core = "I didn't catch that. Please tell me your essential monthly expenses. You can also type 'back' to return to the main menu."
-            return maybe_polish_and_return(core, user_input, profile)
+            return core
 
     # --- Keyword-based intents (start conversations) ---
-    if "budget" in raw_text or "plan" in raw_text:
-        profile["conversation_state"] = "getting_income_for_budget"
-        core = "Let's create a budget. What is your total monthly income after tax? You can also type 'back' to return to the main menu."
-        return maybe_polish_and_return(core, user_input, profile)
-
-    elif "emergency fund" in raw_text or "emergency" in raw_text:
-        profile["conversation_state"] = "getting_emergency_expenses"
-        core = "What are your essential monthly expenses (rent, food, utilities, EMIs)? You can also type 'back' to return to the main menu."
-        return maybe_polish_and_return(core, user_input, profile)
-
-    elif "goal" in raw_text:
-        profile["conversation_state"] = "getting_goal_amount"
-        core = "What is the target amount you want to save? You can also type 'back' to return to the main menu."
-        return maybe_polish_and_return(core, user_input, profile)
-
-    elif "tax" in raw_text:
-        core = (
-            "In India, you can save taxes using several sections:\n\n"
-            "1. Section 80C (up to ₹1.5 lakh): PPF, ELSS, Life Insurance, principal repayment of home loan.\n"
-            "2. Section 80D: Health insurance premium deduction.\n"
-            "3. NPS (Section 80CCD(1B)): extra deduction of ₹50,000.\n\n"
-            "The best option depends on your goals and risk appetite."
-        )
-        return maybe_polish_and_return(core, user_input, profile)
-
-    elif "invest" in raw_text:
-        core = (
-            "Investment options by risk:\n\n"
-            "- Low risk: FDs, PPF, Debt funds.\n"
-            "- Medium risk: Index funds, Balanced mutual funds.\n"
-            "- High risk: Direct equity, mid/small-cap funds, crypto (small allocation).\n\n"
-            "What is your risk tolerance (low, medium, high)?"
-        )
-        return maybe_polish_and_return(core, user_input, profile)
-
-    elif "hello" in raw_text or "hi" in raw_text:
-        core = "Hello! 👋 How can I help you with your finances today? Try: 'create a budget', 'set a goal', or 'tax'."
-        return maybe_polish_and_return(core, user_input, profile)
+    # One regex pass finds every intent keyword; the dict order sets priority
+    found = set(_INTENT_RE.findall(raw_text))
+    for keyword, (handler, _) in _INTENT_HANDLERS.items():
+        if keyword in found:
+            return handler(profile)
 
     # Default fallback
     core = "I’m not sure about that. Try asking me to 'create a budget', set a 'savings goal', or ask about 'tax' or 'investments'."
-    return maybe_polish_and_return(core, user_input, profile)
+    return core